@@ -6,8 +6,10 @@ Created on Mon Jun 24 16:47:19 2019
 @author: esgario
 """
 
+import os
 import sys
 import numpy as np
+import PIL
 
 import torch
 import torch.nn as nn
@@ -17,18 +19,50 @@ from torch.utils.data.sampler import WeightedRandomSampler
 from torch.nn.utils.clip_grad import clip_grad_norm_
 
 from utils.augmentation import between_class, mixup_data, mixup_criterion
-from utils.customdatasets import CoffeeLeavesDataset
+from utils.customdatasets import CoffeeLeavesDataset, CachedCoffeeLeavesDataset
 from utils.utils import static_graph, plot_confusion_matrix
 from net_models import shallow, resnet34, resnet50, resnet101, alexnet, googlenet, vgg16, mobilenet_v2
 
-from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
-from sklearn.metrics import confusion_matrix
 
 import pickle
-import math
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+# Single background worker for confusion-matrix plots; matplotlib (Agg)
+# rendering happens off the eval hot path
+plot_pool = ThreadPoolExecutor(max_workers=1)
+
+def report_plot_error(future):
+    # Plots are side artifacts; report a failed render instead of silently
+    # dropping it (or crashing the evaluation that submitted it)
+    if future.exception() is not None:
+        print('confusion matrix plot failed: %r' % future.exception())
+
+# All inputs are resized to a fixed 224x224, so cuDNN autotuning picks the
+# fastest conv algorithms once and reuses them; TF32 enables tensor core
+# math for FP32 convs/matmuls on Ampere+ GPUs
+torch.backends.cudnn.benchmark = True
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
 
 clf_label = [ 'leaf_multitask' , 'leaf_disease', 'leaf_severity', 'symptom' ]
 
+# Class names for the confusion-matrix plots, fixed so they are not
+# rebuilt on every evaluation call
+dis_labels = ( 'Healthy', 'Leaf miner', 'Rust', 'Phoma', 'Cercospora' )
+sev_labels = ( 'Healthy', 'Very low', 'Low', 'High', 'Very high' )
+
+# ImageNet statistics; batches cross the PCIe bus as uint8 (1/4 of the FP32
+# bytes) and are normalized on the compute device
+norm_mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+norm_std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+
+if torch.cuda.is_available():
+    norm_mean, norm_std = norm_mean.cuda(), norm_std.cuda()
+
+def normalize_batch(images):
+    return images.float().div_(255.).sub_(norm_mean).div_(norm_std)
+
 def cnn_model(model_name, pretrained=False, num_classes=(5, 5)):
     if model_name == 'shallow':
         model = shallow(num_classes)
@@ -56,7 +90,13 @@ def cnn_model(model_name, pretrained=False, num_classes=(5, 5)):
     
     if torch.cuda.is_available():
         model.cuda()
-    
+        # NHWC layout matches the native tensor core tile format
+        model = model.to(memory_format=torch.channels_last)
+
+        # Fuse the conv+bn+relu chains into generated kernels (PyTorch >= 2.0)
+        if hasattr(torch, 'compile'):
+            model = torch.compile(model, mode='max-autotune')
+
     return model
 
 def sampler(dataset, opt):
@@ -65,102 +105,104 @@ def sampler(dataset, opt):
         balance_factor = 20
 
         data = np.array(dataset.data)
-        dis = data[:,1]
-        sev = data[:,-1]
+        dis = data[:,1].astype(np.int64)
+        sev = data[:,-1].astype(np.int64)
 
         total = len(dis)
-        samplesWeight = np.zeros(total)
 
-        for d in range(5):
-            for s in range(5):
-                targets_sum = sum([a and b for a, b in zip(dis==d, sev==s)])
-
-                idx = np.where([a and b for a, b in zip(dis==d, sev==s)])
-                samplesWeight[idx] = 1 / ((targets_sum + balance_factor) / total)
+        # Joint disease/severity class of each sample
+        key = dis * 5 + sev
+        counts = np.bincount(key, minlength=25)
+        samplesWeight = total / (counts[key] + balance_factor)
 
     elif opt.select_clf < 3:
 
         data = np.array(dataset.data)
         labels = data[:,1] if opt.select_clf == 1 else data[:,-1]
+        labels = labels.astype(np.int64)
 
         total = len(labels)
-        samplesWeight = np.zeros(total)
+        counts = np.bincount(labels, minlength=5)
+        samplesWeight = total / counts[labels]
 
-        for i in range(5):
-            targets_sum = sum(labels==i)
-            idx = np.where(labels==i)
-            samplesWeight[idx] = 1 / ((targets_sum) / total)
-        
     # Others
     else:
-        targets = np.array([ x[1] for x in dataset.samples ])
+        targets = np.array([ x[1] for x in dataset.samples ], dtype=np.int64)
         total = len(targets)
 
-        samplesWeight = np.zeros(total)
-
-        for t in np.unique(targets):
-            idx = np.where(targets == t)[0]
-
-            samplesWeight[idx] = 1 / (len(idx) / total)
+        counts = np.bincount(targets)
+        samplesWeight = total / counts[targets]
 
 
-    samplesWeight = samplesWeight / sum(samplesWeight)
-    samplesWeight = torch.from_numpy(samplesWeight).double()
+    samplesWeight = samplesWeight / samplesWeight.sum()
+    samplesWeight = torch.from_numpy(samplesWeight).float()
 
     return WeightedRandomSampler(samplesWeight, len(samplesWeight))
 
-def eval_metrics(metric, y_pred, y_true, y2_true=None, lam=None):
-    # If it is not using Mix Up
-    if y2_true is None:
-        if metric == 'acc':
-            return accuracy_score(y_true, y_pred)
+def save_record(record, path):
+    with open(path, 'wb') as fp:
+        pickle.dump(record, fp)
 
-        if metric == 'fs':
-            return f1_score(y_true, y_pred, average='macro')
-    else:
-        if metric == 'acc':
-            return (lam * accuracy_score(y_true, y_pred) + (1 - lam) * accuracy_score(y2_true, y_pred))
+def metrics_from_cm(cm):
+    # Accuracy and macro precision/recall/F1 in O(K^2) from the (true x pred)
+    # confusion matrix, instead of four full passes over the label arrays
+    tp = np.diag(cm).astype(np.float64)
+    precision = tp / np.maximum(cm.sum(axis=0), 1)
+    recall = tp / np.maximum(cm.sum(axis=1), 1)
+    f1 = 2 * precision * recall / np.maximum(precision + recall, 1e-12)
 
-        if metric == 'fs':
-            return (lam * f1_score(y_true, y_pred, average='macro') + (1 - lam) * f1_score(y2_true, y_pred, average='macro'))
+    return tp.sum() / cm.sum(), precision.mean(), recall.mean(), f1.mean()
 
-    return None
+def macro_f1(cm):
+    # Macro-averaged F1 score derived from a (true x pred) confusion matrix
+    tp = cm.diag().float()
+    precision = tp / torch.clamp(cm.sum(0).float(), min=1)
+    recall = tp / torch.clamp(cm.sum(1).float(), min=1)
+    f1 = 2 * precision * recall / torch.clamp(precision + recall, min=1e-12)
 
-def adjust_learning_rate(optimizer, epoch, opt):
-    if opt.optimizer == 'sgd':
-        lr_values = [ 0.01, 0.005, 0.001, 0.0005, 0.0001 ]
-        step = round(opt.epochs / 5)
+    return float(f1.mean())
 
-        idx = min(math.floor(epoch/step), len(lr_values))
-        learning_rate = lr_values[idx]
+def lr_scheduler(optimizer, opt):
+    # SGD steps through a fixed learning rate table; Adam keeps its own rate
+    if opt.optimizer != 'sgd':
+        return None
 
-        for param_group in optimizer.param_groups:
-            param_group['lr'] = learning_rate
+    lr_values = [ 0.01, 0.005, 0.001, 0.0005, 0.0001 ]
+    step = max(round(opt.epochs / 5), 1)
 
-    return optimizer
+    return torch.optim.lr_scheduler.LambdaLR(
+            optimizer,
+            lambda epoch: lr_values[min(epoch // step, len(lr_values) - 1)] / lr_values[0])
 
 def data_loader(opt):
 
+    # Pillow-SIMD versions are tagged '.post'; stock Pillow is the usual
+    # CPU bottleneck of the decode+resize pipeline
+    if '.post' not in getattr(PIL, '__version__', ''):
+        print('Hint: pillow-simd not detected, image decoding will be slower')
+
+    # The disk cache stores images already resized (CachedCoffeeLeavesDataset)
+    use_cache = opt.use_cache and opt.select_clf < 3
+    resize_transforms = [] if use_cache else [transforms.Resize((224, 224))]
+
     # Transforms
-    train_transforms=transforms.Compose([
-            transforms.Resize((224, 224)),
+    train_transforms=transforms.Compose(resize_transforms + [
             transforms.RandomHorizontalFlip(0.5),
             transforms.RandomVerticalFlip(0.5),
             transforms.RandomApply([transforms.RandomRotation(10)], 0.25),
             transforms.ColorJitter(brightness=0.25, contrast=0.25, saturation=0.25),
-            transforms.ToTensor(),
-            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+            transforms.PILToTensor()
             ])
 
-    val_transforms=transforms.Compose([
-            transforms.Resize((224, 224)),
-            transforms.ToTensor(),
-            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    val_transforms=transforms.Compose(resize_transforms + [
+            transforms.PILToTensor()
             ])
 
     # Dataset
     if opt.select_clf < 3:
-        train_dataset = CoffeeLeavesDataset(
+        dataset_cls = CachedCoffeeLeavesDataset if use_cache else CoffeeLeavesDataset
+
+        train_dataset = dataset_cls(
                 csv_file=opt.csv_file,
                 images_dir=opt.images_dir,
                 dataset='train',
@@ -169,7 +211,7 @@ def data_loader(opt):
                 transforms=train_transforms
         )
 
-        val_dataset = CoffeeLeavesDataset(
+        val_dataset = dataset_cls(
                 csv_file=opt.csv_file,
                 images_dir=opt.images_dir,
                 dataset='val',
@@ -178,7 +220,7 @@ def data_loader(opt):
                 transforms=val_transforms
         )
 
-        test_dataset = CoffeeLeavesDataset(
+        test_dataset = dataset_cls(
                 csv_file=opt.csv_file,
                 images_dir=opt.images_dir,
                 dataset='test',
@@ -203,22 +245,31 @@ def data_loader(opt):
             transform=val_transforms)
 
     # Loader
+    loader_kwargs = { 'batch_size':opt.batch_size,
+                      'pin_memory':torch.cuda.is_available() }
+
+    # Decode/augment images in worker processes kept alive between epochs
+    if opt.num_workers > 0:
+        loader_kwargs.update(num_workers=opt.num_workers,
+                             persistent_workers=True,
+                             prefetch_factor=4)
+
     if opt.balanced_dataset:
         train_loader = torch.utils.data.DataLoader(dataset=train_dataset,
-                                                   batch_size=opt.batch_size,
-                                                   sampler=sampler(train_dataset, opt))
+                                                   sampler=sampler(train_dataset, opt),
+                                                   **loader_kwargs)
     else:
         train_loader = torch.utils.data.DataLoader(dataset=train_dataset,
-                                                   batch_size=opt.batch_size,
-                                                   shuffle=True)
+                                                   shuffle=True,
+                                                   **loader_kwargs)
 
     val_loader = torch.utils.data.DataLoader(dataset=val_dataset,
-                                              batch_size=opt.batch_size,
-                                              shuffle=False)
+                                              shuffle=False,
+                                              **loader_kwargs)
 
     test_loader = torch.utils.data.DataLoader(dataset=test_dataset,
-                                              batch_size=opt.batch_size,
-                                              shuffle=False)
+                                              shuffle=False,
+                                              **loader_kwargs)
 
     return train_loader, val_loader, test_loader
 
@@ -227,18 +278,38 @@ def data_loader(opt):
 class MultiTaskClf:
     def __init__(self, parser):
         self.opt = parser.parse_args()
+        self._n_params = None
+
+        # Output locations are fixed for the run; build the paths once
+        label = clf_label[self.opt.select_clf]
+        self._csv_path = Path('results') / label / (self.opt.output_filename + '.csv')
+        self._pth_path = Path('net_weights') / label / (self.opt.output_filename + '.pth')
+        self._log_path = Path('log') / label / (self.opt.output_filename + '.pkl')
+        self._plot_stem = label + '/' + self.opt.output_filename
         
-    def train(self, train_loader, model, criterion, optimizer, data_augmentation=None):
+    def train(self, train_loader, model, criterion, optimizer, data_augmentation=None, scaler=None):
         # tell to pytorch that we are training the model
         model.train()
 
+        if scaler is None:
+            scaler = torch.cuda.amp.GradScaler(enabled=False)
+
         train_metrics = { 'loss':0.0, 'dis_acc':0.0, 'sev_acc':0.0 }
 
+        # Accumulated on-GPU; read back once per epoch
+        loss_sum = 0.0
+        correct_dis = 0.0
+        correct_sev = 0.0
+
         for images, labels_dis, labels_sev in train_loader:
 
             # Loading images on gpu
             if torch.cuda.is_available():
-                images, labels_dis, labels_sev = images.cuda(), labels_dis.cuda(), labels_sev.cuda()
+                images, labels_dis, labels_sev = images.cuda(non_blocking=True), labels_dis.cuda(non_blocking=True), labels_sev.cuda(non_blocking=True)
+                images = images.contiguous(memory_format=torch.channels_last)
+
+            # Normalize the uint8 batch on the compute device
+            images = normalize_batch(images)
 
             # Apply data augmentation
             if data_augmentation == 'bc+':
@@ -249,108 +320,116 @@ class MultiTaskClf:
                 images, labels_dis_a, labels_dis_b, labels_sev_a, labels_sev_b, lam = mixup_data(images, labels_dis, labels_sev)
 
             # Pass images through the network
-            outputs_dis, outputs_sev = model(images)
+            with torch.cuda.amp.autocast(enabled=scaler.is_enabled()):
+                outputs_dis, outputs_sev = model(images)
 
-            # Compute error
-            if data_augmentation == 'bc+':
-                loss_dis = criterion(torch.softmax(outputs_dis,dim=1).log(), labels_dis_a)
-                loss_sev = criterion(torch.softmax(outputs_sev,dim=1).log(), labels_sev_a)
+                # Compute error
+                if data_augmentation == 'bc+':
+                    loss_dis = criterion(torch.softmax(outputs_dis,dim=1).log(), labels_dis_a)
+                    loss_sev = criterion(torch.softmax(outputs_sev,dim=1).log(), labels_sev_a)
 
-            elif data_augmentation == 'mixup':
-                loss_dis = mixup_criterion(criterion, outputs_dis, labels_dis_a, labels_dis_b, lam)
-                loss_sev = mixup_criterion(criterion, outputs_sev, labels_sev_a, labels_sev_b, lam)
+                elif data_augmentation == 'mixup':
+                    loss_dis = mixup_criterion(criterion, outputs_dis, labels_dis_a, labels_dis_b, lam)
+                    loss_sev = mixup_criterion(criterion, outputs_sev, labels_sev_a, labels_sev_b, lam)
 
-            else:
-                loss_dis = criterion(outputs_dis, labels_dis)
-                loss_sev = criterion(outputs_sev, labels_sev)
+                else:
+                    loss_dis = criterion(outputs_dis, labels_dis)
+                    loss_sev = criterion(outputs_sev, labels_sev)
 
             # Clear gradients parameters
-            model.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
 
             # Getting gradients
 
-            (loss_dis + loss_sev).backward()
+            scaler.scale(loss_dis + loss_sev).backward()
 
             # Clipping gradient
+            scaler.unscale_(optimizer)
             clip_grad_norm_(model.parameters(), 5)
 
             # Updating parameters
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
 
             # Compute metrics
             # Loss
-            train_metrics['loss'] += (loss_dis + loss_sev).data.cpu()/2 * len(images)
+            loss_sum += (loss_dis + loss_sev).detach()/2 * len(images)
 
             # Biotic stress metrics
-            pred = torch.max(outputs_dis.data, 1)[1]
+            pred = outputs_dis.argmax(dim=1)
 
-            if torch.cuda.is_available():
-                if data_augmentation == 'mixup':
-                    train_metrics['dis_acc'] += eval_metrics('acc', pred.cpu().int(), labels_dis_a.cpu().int(), labels_dis_b.cpu().int(), lam) * len(images)
-                else:
-                    train_metrics['dis_acc'] += eval_metrics('acc', pred.cpu().int(), labels_dis.cpu().int()) * len(images)
+            if data_augmentation == 'mixup':
+                correct_dis += lam * (pred == labels_dis_a).sum() + (1 - lam) * (pred == labels_dis_b).sum()
+            else:
+                correct_dis += (pred == labels_dis).sum()
 
             # Severity metrics
-            pred = torch.max(outputs_sev.data, 1)[1]
+            pred = outputs_sev.argmax(dim=1)
 
-            if torch.cuda.is_available():
-                if data_augmentation == 'mixup':
-                    train_metrics['sev_acc'] += eval_metrics('acc', pred.cpu().int(), labels_sev_a.cpu().int(), labels_sev_b.cpu().int(), lam) * len(images)
-                else:
-                    train_metrics['sev_acc'] += eval_metrics('acc', pred.cpu().int(), labels_sev.cpu().int()) * len(images)
+            if data_augmentation == 'mixup':
+                correct_sev += lam * (pred == labels_sev_a).sum() + (1 - lam) * (pred == labels_sev_b).sum()
+            else:
+                correct_sev += (pred == labels_sev).sum()
 
 
-        for x in train_metrics:
-            if x != 'loss':
-                train_metrics[x] = 100.0 * train_metrics[x] / len(train_loader.dataset)
-            else:
-                train_metrics[x] = train_metrics[x] / len(train_loader.dataset)
+        # Single device -> host sync per epoch
+        total = len(train_loader.dataset)
+        train_metrics['loss'] = float(loss_sum) / total
+        train_metrics['dis_acc'] = 100.0 * float(correct_dis) / total
+        train_metrics['sev_acc'] = 100.0 * float(correct_sev) / total
 
         return train_metrics
     
     def validation(self, val_loader, model, criterion):
         # tell to pytorch that we are evaluating the model
         model.eval()
-    
+
         val_metrics = { 'loss':0.0, 'dis_acc':0.0, 'sev_acc':0.0, 'mean_fs':0.0 }
 
+        # Accumulated on-GPU; read back once per epoch
+        loss_sum = 0.0
+        cm_dis = 0
+        cm_sev = 0
+
         with torch.no_grad():
             for images, labels_dis, labels_sev in val_loader:
                 # Loading images on gpu
                 if torch.cuda.is_available():
-	                images, labels_dis, labels_sev = images.cuda(), labels_dis.cuda(), labels_sev.cuda()
+                    images, labels_dis, labels_sev = images.cuda(non_blocking=True), labels_dis.cuda(non_blocking=True), labels_sev.cuda(non_blocking=True)
+                    images = images.contiguous(memory_format=torch.channels_last)
 
-	            # pass images through the network
+                # Normalize the uint8 batch on the compute device
+                images = normalize_batch(images)
+
+                # pass images through the network
                 outputs_dis, outputs_sev = model(images)
-                
+
                 # calculate loss
                 loss_dis = criterion(outputs_dis, labels_dis)
                 loss_sev = criterion(outputs_sev, labels_sev)
 
-	            # Compute metrics
-	            ## Loss
-                val_metrics['loss'] += (loss_dis + loss_sev).data.cpu()/2 * len(images)
+                # Compute metrics
+                ## Loss
+                loss_sum += (loss_dis + loss_sev).detach()/2 * len(images)
 
-	            # Biotic stress metrics
-                pred = torch.max(outputs_dis.data, 1)[1]
-    
-                if torch.cuda.is_available():
-                    val_metrics['dis_acc'] += eval_metrics('acc', pred.cpu().int(), labels_dis.cpu().int()) * len(images)
-                    val_metrics['mean_fs'] += eval_metrics('fs', pred.cpu().int(), labels_dis.cpu().int()) * len(images) * 0.5
+                # Biotic stress confusion matrix
+                pred = outputs_dis.argmax(dim=1)
+                cm_dis = cm_dis + torch.bincount(labels_dis * 5 + pred, minlength=25)
 
-                # Severity metrics
-                pred = torch.max(outputs_sev.data, 1)[1]
+                # Severity confusion matrix
+                pred = outputs_sev.argmax(dim=1)
+                cm_sev = cm_sev + torch.bincount(labels_sev * 5 + pred, minlength=25)
 
-                if torch.cuda.is_available():
-                    val_metrics['sev_acc'] += eval_metrics('acc', pred.cpu().int(), labels_sev.cpu().int()) * len(images)
-                    val_metrics['mean_fs'] += eval_metrics('fs', pred.cpu().int(), labels_sev.cpu().int()) * len(images) * 0.5
-    
-    
-        for x in val_metrics:
-            if x != 'loss':
-                val_metrics[x] = 100.0 * val_metrics[x] / len(val_loader.dataset)
-            else:
-                val_metrics[x] = val_metrics[x] / len(val_loader.dataset)
+
+        # Single device -> host sync per epoch
+        total = len(val_loader.dataset)
+        cm_dis = cm_dis.cpu().view(5, 5)
+        cm_sev = cm_sev.cpu().view(5, 5)
+
+        val_metrics['loss'] = float(loss_sum) / total
+        val_metrics['dis_acc'] = 100.0 * float(cm_dis.diag().sum()) / total
+        val_metrics['sev_acc'] = 100.0 * float(cm_sev.diag().sum()) / total
+        val_metrics['mean_fs'] = 100.0 * (macro_f1(cm_dis) + macro_f1(cm_sev)) / 2
 
         return val_metrics
 
@@ -383,6 +462,12 @@ class MultiTaskClf:
         else:
             optimizer = torch.optim.Adam(model.parameters(), lr=0.001, weight_decay=self.opt.weight_decay)
 
+        # Gradient scaler for mixed precision training
+        scaler = torch.cuda.amp.GradScaler(enabled=self.opt.amp and torch.cuda.is_available())
+
+        # Scheduler
+        scheduler = lr_scheduler(optimizer, self.opt)
+
         record = {}
         record['model'] = self.opt.model
         record['batch_size'] = self.opt.batch_size
@@ -400,9 +485,14 @@ class MultiTaskClf:
 
         best_fs = 0.0
 
+        # Checkpoint/log writes happen off the main thread; the futures are
+        # kept so write failures surface instead of being dropped
+        io_pool = ThreadPoolExecutor(max_workers=1)
+        io_jobs = []
+
         for epoch in range(self.opt.epochs):
             # Training
-            train_metrics = self.train(train_loader, model, criterion_train, optimizer, self.opt.data_augmentation)
+            train_metrics = self.train(train_loader, model, criterion_train, optimizer, self.opt.data_augmentation, scaler)
             self.print_info(data_type='TRAIN', metrics=train_metrics, epoch=epoch, epochs=self.opt.epochs)
 
             # Validation
@@ -410,7 +500,8 @@ class MultiTaskClf:
             self.print_info(data_type='VAL', metrics=val_metrics, epoch=epoch, epochs=self.opt.epochs)
 
             # Adjust learning rate
-            optimizer = adjust_learning_rate(optimizer, epoch, self.opt)
+            if scheduler is not None:
+                scheduler.step()
 
             # Recording metrics
             record['train_loss'].append(train_metrics['loss'])
@@ -426,119 +517,180 @@ class MultiTaskClf:
             if (curr_fs > best_fs) and epoch >= 5:
                 best_fs = curr_fs
 
-                # Saving model
-                torch.save(model, 'net_weights/' + clf_label[self.opt.select_clf] + '/' + self.opt.output_filename + '.pth')
+                # Saving model; copy=True forces a real snapshot even when the
+                # parameters already live on the CPU, so the background write
+                # never races the next epoch's in-place optimizer updates.
+                # Unwrapping _orig_mod keeps the checkpoint free of the
+                # torch.compile key prefix, so it loads on any host
+                state = { k: v.detach().to('cpu', copy=True) for k, v in getattr(model, '_orig_mod', model).state_dict().items() }
+                io_jobs.append(io_pool.submit(torch.save, state, self._pth_path))
                 print('model saved')
 
-            # Saving log
-            fp = open('log/' + clf_label[self.opt.select_clf] + '/' + self.opt.output_filename + '.pkl', 'wb')
-            pickle.dump(record, fp)
-            fp.close()
+            # Saving log (snapshot written in the background)
+            snapshot = { k: list(v) if isinstance(v, list) else v for k, v in record.items() }
+            io_jobs.append(io_pool.submit(save_record, snapshot, self._log_path))
+
+        # Wait for pending checkpoint/log writes and re-raise any failure
+        io_pool.shutdown(wait=True)
+        for job in io_jobs:
+            job.result()
 
         # Plot
         # static_graph(np.array(record['train_dis_acc'])/100, np.array(record['val_dis_acc'])/100)
 
-    def run_test(self):
+    def run_test(self, return_preds=False):
         # Dataset
         _, _, test_loader = data_loader(self.opt)
 
         # Loading model
-        model = torch.load('net_weights/' + clf_label[self.opt.select_clf] + '/' + self.opt.output_filename + '.pth')
-        model.cuda()
+        model = cnn_model(self.opt.model, num_classes=(5, 5))
+        state = torch.load(self._pth_path,
+                           map_location='cuda' if torch.cuda.is_available() else 'cpu')
+        # Checkpoints are stored without the torch.compile key prefix
+        getattr(model, '_orig_mod', model).load_state_dict(state)
         # tell to pytorch that we are evaluating the model
         model.eval()
 
-        y_pred_dis = np.empty(0)
-        y_true_dis = np.empty(0)
+        # The metrics only need the on-device confusion matrices; the full
+        # O(N) label arrays are staged in pinned buffers (asynchronous
+        # per-batch D2H copies) only when the caller asks for them
+        if return_preds:
+            n_samples = len(test_loader.dataset)
+            pin = torch.cuda.is_available()
+
+            pred_dis_buf = torch.empty(n_samples, dtype=torch.int64, pin_memory=pin)
+            true_dis_buf = torch.empty(n_samples, dtype=torch.int64, pin_memory=pin)
+
+            pred_sev_buf = torch.empty(n_samples, dtype=torch.int64, pin_memory=pin)
+            true_sev_buf = torch.empty(n_samples, dtype=torch.int64, pin_memory=pin)
 
-        y_pred_sev = np.empty(0)
-        y_true_sev = np.empty(0)
+            offset = 0
+
+        # Confusion matrices accumulated on the compute device, one bincount
+        # kernel per batch; transferred to the host once after the loop
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        cm_dis = torch.zeros(25, dtype=torch.int64, device=device)
+        cm_sev = torch.zeros(25, dtype=torch.int64, device=device)
 
         with torch.no_grad():
-	        for i, (images, labels_dis, labels_sev) in enumerate(test_loader):
-	            # Loading images on gpu
-	            if torch.cuda.is_available():
-	                images, labels_dis, labels_sev = images.cuda(), labels_dis.cuda(), labels_sev.cuda()
+            for i, (images, labels_dis, labels_sev) in enumerate(test_loader):
+                # Loading images on gpu
+                if torch.cuda.is_available():
+                    images, labels_dis, labels_sev = images.cuda(non_blocking=True), labels_dis.cuda(non_blocking=True), labels_sev.cuda(non_blocking=True)
+                    images = images.contiguous(memory_format=torch.channels_last)
 
-	            # pass images through the network
-	            outputs_dis, outputs_sev = model(images)
+                # Normalize the uint8 batch on the compute device
+                images = normalize_batch(images)
 
-	            #### Compute metrics
+                # pass images through the network
+                outputs_dis, outputs_sev = model(images)
 
-	            # Biotic stress
-	            pred = torch.max(outputs_dis.data, 1)[1]
+                #### Compute metrics
+                pred_dis = outputs_dis.argmax(dim=1)
+                cm_dis += torch.bincount(labels_dis * 5 + pred_dis, minlength=25)
 
-	            y_pred_dis = np.concatenate( (y_pred_dis, pred.data.cpu().numpy()) )
-	            y_true_dis = np.concatenate( (y_true_dis, labels_dis.data.cpu().numpy()) )
+                pred_sev = outputs_sev.argmax(dim=1)
+                cm_sev += torch.bincount(labels_sev * 5 + pred_sev, minlength=25)
 
-	            # Severity
-	            pred = torch.max(outputs_sev.data, 1)[1]
+                if return_preds:
+                    batch = slice(offset, offset + len(images))
 
-	            y_pred_sev = np.concatenate( (y_pred_sev, pred.data.cpu().numpy()) )
-	            y_true_sev = np.concatenate( (y_true_sev, labels_sev.data.cpu().numpy()) )
+                    pred_dis_buf[batch].copy_(pred_dis, non_blocking=True)
+                    true_dis_buf[batch].copy_(labels_dis, non_blocking=True)
 
-        # Biotic stress
-        acc = accuracy_score(y_true_dis, y_pred_dis)
-        pr = precision_score(y_true_dis, y_pred_dis, average='macro')
-        re = recall_score(y_true_dis, y_pred_dis, average='macro')
-        fs = f1_score(y_true_dis, y_pred_dis, average='macro')
+                    pred_sev_buf[batch].copy_(pred_sev, non_blocking=True)
+                    true_sev_buf[batch].copy_(labels_sev, non_blocking=True)
+
+                    offset += len(images)
+
+        # One sync covers every outstanding copy; .numpy() shares the storage
+        if return_preds and torch.cuda.is_available():
+            torch.cuda.synchronize()
 
-        f = open('results/' + clf_label[self.opt.select_clf] + '/' + self.opt.output_filename + '.csv', 'a')
-        f.write('acc,prec,rec,fs\n%.2f,%.2f,%.2f,%.2f\n' % (acc*100, pr*100, re*100, fs*100))
+        # Biotic stress
+        cm = cm_dis.cpu().numpy().reshape(5, 5)
+        acc, pr, re, fs = metrics_from_cm(cm)
+        metrics = { 'dis': { 'acc': acc, 'prec': pr, 'rec': re, 'f1': fs, 'cm': cm } }
 
-        labels_dis = [ 'Healthy', 'Leaf miner', 'Rust', 'Phoma', 'Cercospora' ]
+        rows = f'{acc*100:.2f},{pr*100:.2f},{re*100:.2f},{fs*100:.2f}\n'
 
         # Confusion matrix
-        cm = confusion_matrix(y_true_dis, y_pred_dis, list(range(0,5)))
-        plot_confusion_matrix(cm=cm, target_names=labels_dis, title=' ', output_name= clf_label[self.opt.select_clf] + '/' + self.opt.output_filename + '_dis')
+        plot_pool.submit(plot_confusion_matrix, cm=cm, target_names=dis_labels, title=' ', output_name=self._plot_stem + '_dis').add_done_callback(report_plot_error)
 
         # Severity
-        acc = accuracy_score(y_true_sev, y_pred_sev)
-        pr = precision_score(y_true_sev, y_pred_sev, average='macro')
-        re = recall_score(y_true_sev, y_pred_sev, average='macro')
-        fs = f1_score(y_true_sev, y_pred_sev, average='macro')
-
-        f.write('%.2f,%.2f,%.2f,%.2f\n' % (acc*100, pr*100, re*100, fs*100))
+        cm = cm_sev.cpu().numpy().reshape(5, 5)
+        acc, pr, re, fs = metrics_from_cm(cm)
+        metrics['sev'] = { 'acc': acc, 'prec': pr, 'rec': re, 'f1': fs, 'cm': cm }
 
-        labels_sev = [ 'Healthy', 'Very low', 'Low', 'High', 'Very high' ]
+        rows += f'{acc*100:.2f},{pr*100:.2f},{re*100:.2f},{fs*100:.2f}\n'
 
         # Confusion matrix
-        cm = confusion_matrix(y_true_sev, y_pred_sev, list(range(0,5)))
-        plot_confusion_matrix(cm=cm, target_names=labels_sev, title=' ', output_name= clf_label[self.opt.select_clf] + '/' + self.opt.output_filename + '_sev')
+        plot_pool.submit(plot_confusion_matrix, cm=cm, target_names=sev_labels, title=' ', output_name=self._plot_stem + '_sev').add_done_callback(report_plot_error)
+
+        # Single buffered append; the header is only written to a fresh file
+        csv_path = self._csv_path
+        if not (os.path.exists(csv_path) and os.path.getsize(csv_path) > 0):
+            rows = 'acc,prec,rec,fs\n' + rows
+
+        with open(csv_path, 'a', buffering=65536) as f:
+            f.write(rows)
 
-        f.close()
+        if return_preds:
+            return true_dis_buf.numpy(), pred_dis_buf.numpy(), true_sev_buf.numpy(), pred_sev_buf.numpy(), metrics
 
-        return y_true_dis, y_pred_dis, y_true_sev, y_pred_sev
+        return metrics
 
     def get_n_params(self):
-        model = torch.load('net_weights/' + clf_label[self.opt.select_clf] +'/' + self.opt.output_filename + '.pth')
-        pp=0
-        for p in list(model.parameters()):
-            nn=1
-            for s in list(p.size()):
-                nn = nn*s
-            pp += nn
-        return pp
+        # Memoized; the checkpoint is only read from disk on the first call
+        if self._n_params is None:
+            path = self._pth_path
+            try:
+                # Memory-map the storages; counting elements only touches
+                # tensor metadata, so the weights are never paged in
+                state = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+            except TypeError:
+                # mmap/weights_only need PyTorch >= 2.1 / 1.13
+                state = torch.load(path, map_location='cpu')
+            self._n_params = sum(p.numel() for p in state.values())
+        return self._n_params
 
 # ---------------------------------------------------------------------- #
         
 class OneTaskClf:
     def __init__(self, parser):
         self.opt = parser.parse_args()
+        self._n_params = None
 
-    def train(self, train_loader, model, criterion, optimizer, data_augmentation=None):
+        # Output locations are fixed for the run; build the paths once
+        label = clf_label[self.opt.select_clf]
+        self._csv_path = Path('results') / label / (self.opt.output_filename + '.csv')
+        self._pth_path = Path('net_weights') / label / (self.opt.output_filename + '.pth')
+        self._log_path = Path('log') / label / (self.opt.output_filename + '.pkl')
+        self._plot_stem = label + '/' + self.opt.output_filename
+
+    def train(self, train_loader, model, criterion, optimizer, data_augmentation=None, scaler=None):
         # tell to pytorch that we are training the model
         model.train()
 
+        if scaler is None:
+            scaler = torch.cuda.amp.GradScaler(enabled=False)
+
         train_metrics = { 'loss':0.0, 'acc':0.0 }
-        correct = 0
+
+        # Accumulated on-GPU
+        loss_sum = 0.0
+        correct = 0.0
         total = 0
 
         for i, (images, labels) in enumerate(train_loader):
 
             # Loading images on gpu
             if torch.cuda.is_available():
-                images, labels = images.cuda(), labels.cuda()
+                images, labels = images.cuda(non_blocking=True), labels.cuda(non_blocking=True)
+                images = images.contiguous(memory_format=torch.channels_last)
+
+            # Normalize the uint8 batch on the compute device
+            images = normalize_batch(images)
 
             if data_augmentation == 'bc+':
                 images, labels_a, _ = between_class(images, labels)
@@ -548,55 +700,60 @@ class OneTaskClf:
                 images, labels_a, labels_b, lam = mixup_data(images, labels)
 
             # Clear gradients parameters
-            model.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
 
             # pass images through the network
-            outputs = model(images)
+            with torch.cuda.amp.autocast(enabled=scaler.is_enabled()):
+                outputs = model(images)
 
-            if data_augmentation == 'bc+':
-                loss = criterion(torch.softmax(outputs, dim=1).log(), labels_a)
+                if data_augmentation == 'bc+':
+                    loss = criterion(torch.softmax(outputs, dim=1).log(), labels_a)
 
-            elif data_augmentation == 'mixup':
-                loss = mixup_criterion(criterion, outputs, labels_a, labels_b, lam)
+                elif data_augmentation == 'mixup':
+                    loss = mixup_criterion(criterion, outputs, labels_a, labels_b, lam)
 
-            else:
-                loss = criterion(outputs, labels)
+                else:
+                    loss = criterion(outputs, labels)
 
             # Getting gradients
-            loss.backward()
+            scaler.scale(loss).backward()
 
             # Clipping gradient
+            scaler.unscale_(optimizer)
             clip_grad_norm_(model.parameters(), 5)
 
             # Updating parameters
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
 
             # Compute metrics
             ## Loss
-            train_metrics['loss'] += loss.data.cpu() * len(images)
+            loss_sum += loss.detach() * len(images)
 
             ## Accuracy
-            pred = torch.max(outputs.data, 1)[1]
+            pred = outputs.argmax(dim=1)
 
-            if torch.cuda.is_available():
-                if data_augmentation == 'mixup':
-                    correct += eval_metrics('acc', pred.cpu().int(), labels_a.cpu().int(), labels_b.cpu().int(), lam) * len(images)
-                else:
-                    correct += eval_metrics('acc', pred.cpu().int(), labels.cpu().int()) * len(images)
+            if data_augmentation == 'mixup':
+                correct += lam * (pred == labels_a).sum() + (1 - lam) * (pred == labels_b).sum()
+            else:
+                correct += (pred == labels).sum()
 
             total += labels.size(0)
 
-            train_metrics['acc'] = 100.0 * float(correct) / total
+            ## Progress updates are throttled; reading the running accuracy
+            ## forces a GPU sync, so only do it when actually printing
+            if (i+1) % 20 == 0 or i+1 == len(train_loader):
+                train_metrics['acc'] = 100.0 * float(correct) / total
 
-            ## Completed percentage
-            p = (100.0*(i+1))/len(train_loader)
+                ## Completed percentage
+                p = (100.0*(i+1))/len(train_loader)
 
-            sys.stdout.write("\r[%s][%.2f%%][ACC:%.2f]" % ('='*round(p/2) + '-'*(50 - round(p/2)), p, train_metrics['acc']))
-            sys.stdout.flush()
+                sys.stdout.write("\r[%s][%.2f%%][ACC:%.2f]" % ('='*round(p/2) + '-'*(50 - round(p/2)), p, train_metrics['acc']))
+                sys.stdout.flush()
 
         print('')
 
-        train_metrics['loss'] = train_metrics['loss'] / len(train_loader.dataset)
+        train_metrics['loss'] = float(loss_sum) / len(train_loader.dataset)
 
         return train_metrics
 
@@ -605,17 +762,23 @@ class OneTaskClf:
         model.eval()
 
         val_metrics = { 'loss':0.0, 'acc':0.0, 'fs':0.0 }
-        correct_acc = 0
-        correct_fs = 0
+
+        # Accumulated on-GPU; read back once per epoch
+        loss_sum = 0.0
+        cm = 0
         total = 0
 
         with torch.no_grad():
             for i, (images, labels) in enumerate(val_loader):
-	            # Loading images on gpu
+                # Loading images on gpu
                 if torch.cuda.is_available():
-                    images, labels = images.cuda(), labels.cuda()
+                    images, labels = images.cuda(non_blocking=True), labels.cuda(non_blocking=True)
+                    images = images.contiguous(memory_format=torch.channels_last)
+
+                # Normalize the uint8 batch on the compute device
+                images = normalize_batch(images)
 
-	            # pass images through the network
+                # pass images through the network
                 outputs = model(images)
 
                 # calculate loss
@@ -623,29 +786,29 @@ class OneTaskClf:
 
                 # Compute metrics
                 ## Loss
-                val_metrics['loss'] += loss.data.cpu() * len(images)
+                loss_sum += loss.detach() * len(images)
 
-               ## Accuracy
-                pred = torch.max(outputs.data, 1)[1]
-
-                if torch.cuda.is_available():
-                    correct_acc += eval_metrics('acc', pred.cpu().int(), labels.cpu().int()) * len(images)
-                    correct_fs += eval_metrics('fs', pred.cpu().int(), labels.cpu().int()) * len(images)
+                ## Confusion matrix
+                pred = outputs.argmax(dim=1)
+                cm = cm + torch.bincount(labels * 5 + pred, minlength=25)
 
                 total += labels.size(0)
 
-                val_metrics['acc'] = 100.0 * float(correct_acc) / total
-                val_metrics['fs'] = 100.0 * float(correct_fs) / total
+                # Completed percentage (throttled)
+                if (i+1) % 20 == 0 or i+1 == len(val_loader):
+                    p = (100.0*(i+1))/len(val_loader)
 
-                # Completed percentage
-                p = (100.0*(i+1))/len(val_loader)
-
-                sys.stdout.write("\r[%s][%.2f%%][ACC:%.2f][FS:%.2f]" % ('='*round(p/2) + '-'*(50 - round(p/2)), p, val_metrics['acc'], val_metrics['fs']))
-                sys.stdout.flush()
+                    sys.stdout.write("\r[%s][%.2f%%]" % ('='*round(p/2) + '-'*(50 - round(p/2)), p))
+                    sys.stdout.flush()
 
         print('')
 
-        val_metrics['loss'] = val_metrics['loss'] / len(val_loader.dataset)
+        # Single device -> host sync per epoch
+        cm = cm.cpu().view(5, 5)
+
+        val_metrics['loss'] = float(loss_sum) / len(val_loader.dataset)
+        val_metrics['acc'] = 100.0 * float(cm.diag().sum()) / total
+        val_metrics['fs'] = 100.0 * macro_f1(cm)
 
         return val_metrics
 
@@ -677,6 +840,12 @@ class OneTaskClf:
         else:
             optimizer = torch.optim.Adam(model.parameters(), lr=0.001, weight_decay=self.opt.weight_decay)
 
+        # Gradient scaler for mixed precision training
+        scaler = torch.cuda.amp.GradScaler(enabled=self.opt.amp and torch.cuda.is_available())
+
+        # Scheduler
+        scheduler = lr_scheduler(optimizer, self.opt)
+
         record = {}
         record['model'] = self.opt.model
         record['batch_size'] = self.opt.batch_size
@@ -692,9 +861,14 @@ class OneTaskClf:
 
         best_fs = 0.0
 
+        # Checkpoint/log writes happen off the main thread; the futures are
+        # kept so write failures surface instead of being dropped
+        io_pool = ThreadPoolExecutor(max_workers=1)
+        io_jobs = []
+
         for epoch in range(self.opt.epochs):
             # Training
-            train_metrics = self.train(train_loader, model, criterion_train, optimizer, self.opt.data_augmentation)
+            train_metrics = self.train(train_loader, model, criterion_train, optimizer, self.opt.data_augmentation, scaler)
             self.print_info(data_type='TRAIN', metrics=train_metrics, epoch=epoch, epochs=self.opt.epochs)
 
             # Validation
@@ -702,7 +876,8 @@ class OneTaskClf:
             self.print_info(data_type='VAL', metrics=val_metrics, epoch=epoch, epochs=self.opt.epochs)
 
             # Adjust learning rate
-            optimizer = adjust_learning_rate(optimizer, epoch, self.opt)
+            if scheduler is not None:
+                scheduler.step()
 
             # Recording metrics
             record['train_loss'].append(train_metrics['loss'])
@@ -716,73 +891,118 @@ class OneTaskClf:
             if (curr_fs > best_fs) and epoch >= 5:
                 best_fs = curr_fs
 
-                # Saving model
-                torch.save(model, 'net_weights/' + clf_label[self.opt.select_clf] + '/' + self.opt.output_filename + '.pth')
+                # Saving model; copy=True forces a real snapshot even when the
+                # parameters already live on the CPU, so the background write
+                # never races the next epoch's in-place optimizer updates.
+                # Unwrapping _orig_mod keeps the checkpoint free of the
+                # torch.compile key prefix, so it loads on any host
+                state = { k: v.detach().to('cpu', copy=True) for k, v in getattr(model, '_orig_mod', model).state_dict().items() }
+                io_jobs.append(io_pool.submit(torch.save, state, self._pth_path))
                 print('model saved')
 
-            # Saving log
-            fp = open('log/' + clf_label[self.opt.select_clf] + '/' + self.opt.output_filename + '.pkl', 'wb')
+            # Saving log (snapshot written in the background)
+            snapshot = { k: list(v) if isinstance(v, list) else v for k, v in record.items() }
+            io_jobs.append(io_pool.submit(save_record, snapshot, self._log_path))
 
-            pickle.dump(record, fp)
-            fp.close()
+        # Wait for pending checkpoint/log writes and re-raise any failure
+        io_pool.shutdown(wait=True)
+        for job in io_jobs:
+            job.result()
 
         # Plot
         # static_graph(np.array(record['train_acc'])/100, np.array(record['val_acc'])/100)
 
-    def run_test(self):
+    def run_test(self, return_preds=False):
         # Dataset
         _, _, test_loader = data_loader(self.opt)
 
         # Loading model
-        model = torch.load('net_weights/' + clf_label[self.opt.select_clf] + '/' + self.opt.output_filename + '.pth')
-        model.cuda()
+        model = cnn_model(self.opt.model, num_classes=5)
+        state = torch.load(self._pth_path,
+                           map_location='cuda' if torch.cuda.is_available() else 'cpu')
+        # Checkpoints are stored without the torch.compile key prefix
+        getattr(model, '_orig_mod', model).load_state_dict(state)
         model.eval()
 
-        y_pred = np.empty(0)
-        y_true = np.empty(0)
+        # The metrics only need the on-device confusion matrix; the full
+        # O(N) label arrays are staged in pinned buffers (asynchronous
+        # per-batch D2H copies) only when the caller asks for them
+        if return_preds:
+            n_samples = len(test_loader.dataset)
+            pin = torch.cuda.is_available()
+
+            pred_buf = torch.empty(n_samples, dtype=torch.int64, pin_memory=pin)
+            true_buf = torch.empty(n_samples, dtype=torch.int64, pin_memory=pin)
+
+            offset = 0
+
+        # Confusion matrix accumulated on the compute device, one bincount
+        # kernel per batch; transferred to the host once after the loop
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        cm_acc = torch.zeros(25, dtype=torch.int64, device=device)
 
         with torch.no_grad():
-	        for i, (images, labels) in enumerate(test_loader):
-	            # Loading images on gpu
-	            if torch.cuda.is_available():
-	                images, labels = images.cuda(), labels.cuda()
-
-	            # pass images through the network
-	            outputs = model(images)
-
-	            # Compute metrics
-	            pred = torch.max(outputs.data, 1)[1]
-	            y_pred = np.concatenate( (y_pred, pred.data.cpu().numpy()) )
-	            y_true = np.concatenate( (y_true, labels.data.cpu().numpy()) )
-
-        # Biotic stress labels
-        acc = accuracy_score(y_true, y_pred)
-        pr = precision_score(y_true, y_pred, average='macro')
-        re = recall_score(y_true, y_pred, average='macro')
-        fs = f1_score(y_true, y_pred, average='macro')
-
-        f = open('results/' + clf_label[self.opt.select_clf] + '/' + self.opt.output_filename + '.csv', 'a')
-        f.write('acc,prec,rec,fs\n%.2f,%.2f,%.2f,%.2f\n' % (acc*100, pr*100, re*100, fs*100))
-
-        if self.opt.select_clf != 2:
-            labels = [ 'Healhty', 'Leaf miner', 'Rust', 'Phoma', 'Cercospora' ]
-        else:
-            labels = [ 'Healthy', 'Very low', 'Low', 'High', 'Very high' ]
+            for i, (images, labels) in enumerate(test_loader):
+                # Loading images on gpu
+                if torch.cuda.is_available():
+                    images, labels = images.cuda(non_blocking=True), labels.cuda(non_blocking=True)
+                    images = images.contiguous(memory_format=torch.channels_last)
+
+                # Normalize the uint8 batch on the compute device
+                images = normalize_batch(images)
+
+                # pass images through the network
+                outputs = model(images)
+
+                # Compute metrics
+                pred = outputs.argmax(dim=1)
+                cm_acc += torch.bincount(labels * 5 + pred, minlength=25)
+
+                if return_preds:
+                    batch = slice(offset, offset + len(images))
+
+                    pred_buf[batch].copy_(pred, non_blocking=True)
+                    true_buf[batch].copy_(labels, non_blocking=True)
+
+                    offset += len(images)
+
+        # One sync covers every outstanding copy; .numpy() shares the storage
+        if return_preds and torch.cuda.is_available():
+            torch.cuda.synchronize()
 
         # Confusion matrix
-        cm = confusion_matrix(y_true, y_pred, list(range(0,5)))
-        plot_confusion_matrix(cm=cm, target_names=labels, title=' ', output_name=clf_label[self.opt.select_clf] + '/' + self.opt.output_filename)
+        cm = cm_acc.cpu().numpy().reshape(5, 5)
+        acc, pr, re, fs = metrics_from_cm(cm)
+        metrics = { 'acc': acc, 'prec': pr, 'rec': re, 'f1': fs, 'cm': cm }
+
+        # Single buffered append; the header is only written to a fresh file
+        csv_path = self._csv_path
+        row = f'{acc*100:.2f},{pr*100:.2f},{re*100:.2f},{fs*100:.2f}\n'
+        if not (os.path.exists(csv_path) and os.path.getsize(csv_path) > 0):
+            row = 'acc,prec,rec,fs\n' + row
+
+        with open(csv_path, 'a', buffering=65536) as f:
+            f.write(row)
+
+        labels = dis_labels if self.opt.select_clf != 2 else sev_labels
+
+        plot_pool.submit(plot_confusion_matrix, cm=cm, target_names=labels, title=' ', output_name=self._plot_stem).add_done_callback(report_plot_error)
 
-        f.close()
+        if return_preds:
+            return true_buf.numpy(), pred_buf.numpy(), metrics
 
-        return y_true, y_pred
+        return metrics
 
     def get_n_params(self):
-        model = torch.load('net_weights/' + clf_label[self.opt.select_clf] + '/' + self.opt.output_filename + '.pth')
-        pp=0
-        for p in list(model.parameters()):
-            nn=1
-            for s in list(p.size()):
-                nn = nn*s
-            pp += nn
-        return pp
+        # Memoized; the checkpoint is only read from disk on the first call
+        if self._n_params is None:
+            path = self._pth_path
+            try:
+                # Memory-map the storages; counting elements only touches
+                # tensor metadata, so the weights are never paged in
+                state = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+            except TypeError:
+                # mmap/weights_only need PyTorch >= 2.1 / 1.13
+                state = torch.load(path, map_location='cpu')
+            self._n_params = sum(p.numel() for p in state.values())
+        return self._n_params
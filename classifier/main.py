@@ -1,3 +1,4 @@
+import os
 import sys
 import warnings
 import argparse
@@ -15,10 +16,13 @@ if __name__ == '__main__':
     parser.add_argument('--batch_size', type=int, default=24)
     parser.add_argument('--weight_decay', type=float, default=5e-4)
     parser.add_argument('--data_augmentation', type=str, default='standard')
+    parser.add_argument('--amp', action='store_true')
     parser.add_argument('--model', type=str, default='resnet50')
     parser.add_argument('--epochs', type=int, default=80)
     parser.add_argument('--pretrained', type=bool, default=True)
     parser.add_argument('--balanced_dataset', type=bool, default=False)
+    parser.add_argument('--num_workers', type=int, default=(os.cpu_count() or 2) // 2)
+    parser.add_argument('--use_cache', action='store_true')
     # Dataset
     parser.add_argument('--csv_file', type=str, default='dataset/dataset.csv')
     parser.add_argument('--fold', type=int, default=1)
@@ -53,8 +57,4 @@ if __name__ == '__main__':
     if options.train:
         Clf.run_training()
     else:
-        if options.select_clf == 0:
-            y_true_dis, y_pred_dis, y_true_sev, y_pred_sev = Clf.run_test()    
-            
-        else:
-            y_true, y_pred = Clf.run_test()
+        metrics = Clf.run_test()
@@ -29,6 +29,11 @@ class CoffeeLeavesDataset(Dataset):
         self.images_dir = images_dir
         self.select_dataset = select_dataset
         self.transformations = transforms
+
+        # Labels precomputed as index tensors, avoiding a pandas lookup
+        # and tensor allocation per sample
+        self.labels_dis = torch.as_tensor(self.data.iloc[:, 1].to_numpy(np.int64))
+        self.labels_sev = torch.as_tensor(self.data.iloc[:, -1].to_numpy(np.int64))
         
     def __len__(self):
         return len(self.data)
@@ -46,11 +51,8 @@ class CoffeeLeavesDataset(Dataset):
             image = self.transformations(image)
 
          # Get label of the image
-        label_dis = self.data.iloc[idx, 1]
-        label_dis = torch.tensor(label_dis, dtype=torch.long)
-    
-        label_sev = self.data.iloc[idx, -1]
-        label_sev =  torch.tensor(label_sev, dtype=torch.long)
+        label_dis = self.labels_dis[idx]
+        label_sev = self.labels_sev[idx]
         
         # Multitask
         if self.select_dataset == 0:
@@ -96,4 +98,67 @@ class CoffeeLeavesDataset(Dataset):
         else:
             return csv.iloc[test_indices]
 
+
+class CachedCoffeeLeavesDataset(CoffeeLeavesDataset):
+    """Coffee Leaves Dataset backed by a disk cache of pre-resized images.
+
+    JPEG decoding and resizing are deterministic, so each image is decoded,
+    resized and stored as a uint8 tensor the first time it is requested;
+    later epochs only pay for the stochastic transforms.
+    """
+
+    def __init__(self, csv_file, images_dir, dataset, fold=1, select_dataset=0,
+                 transforms=None, cache_dir=None, image_size=(224, 224)):
+        super().__init__(csv_file, images_dir, dataset, fold, select_dataset, transforms)
+
+        self.image_size = image_size
+        self.cache_dir = cache_dir if cache_dir else os.path.join(images_dir, 'cache')
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def cache_path(self, idx):
+        return os.path.join(self.cache_dir, str(self.data.iloc[idx, 0]) + '.pt')
+
+    def __getitem__(self, idx):
+
+        cache_file = self.cache_path(idx)
+
+        image = None
+        if os.path.exists(cache_file):
+            try:
+                image = Image.fromarray(torch.load(cache_file).numpy())
+            except Exception:
+                # Truncated/corrupt entry (e.g. interrupted first epoch);
+                # treat it as a miss and rewrite it below
+                image = None
+
+        if image is None:
+            img_name = os.path.join(self.images_dir,
+                                    str(self.data.iloc[idx, 0]) + '.jpg')
+            # BILINEAR matches transforms.Resize on the non-cached path;
+            # delete the cache directory if this filter is ever changed
+            image = Image.open(img_name).resize(self.image_size, resample=Image.BILINEAR)
+            # Write atomically so concurrent workers and interrupts never
+            # leave a half-written file at the final path
+            tmp_file = cache_file + '.%d.tmp' % os.getpid()
+            torch.save(torch.from_numpy(np.asarray(image, dtype=np.uint8)), tmp_file)
+            os.replace(tmp_file, cache_file)
+
+        # Apply transformations (resize excluded, images are cached resized)
+        if self.transformations:
+            image = self.transformations(image)
+
+         # Get label of the image
+        label_dis = self.labels_dis[idx]
+        label_sev = self.labels_sev[idx]
+
+        # Multitask
+        if self.select_dataset == 0:
+            return (image, label_dis, label_sev)
+        # Disease
+        elif self.select_dataset == 1:
+            return (image, label_dis)
+        # Severity
+        else:
+            return (image, label_sev)
+
         
@@ -11,6 +11,10 @@ from bokeh.io import show
 from bokeh.models import LinearAxis, Range1d
 from sklearn.metrics import confusion_matrix
 import numpy as np
+import matplotlib
+# Non-interactive backend; figures are rendered straight to file and can
+# safely be drawn from a background thread
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
 def line_graph(train, val):
@@ -144,14 +148,13 @@ def multilabel_confusion_matrix(y_true, y_pred):
     
     target_names = ['0', 'B', 'F', 'P', 'C', 'BF', 'BP', 'BC', 'FP', 'FC', 'PC' ]
     
-    true_label = []
-    pred_label = []
-    
-    for i in range(0, len(y_true)):
-        true_label.append(sum([ y_true[i][j]*10**(3-j) for j in range(0,4) ]))
-        pred_label.append(sum([ y_pred[i][j]*10**(3-j) for j in range(0,4) ]))
-        
-    cm = confusion_matrix(true_label, pred_label, labels)
+    # Encode the four binary columns as a single decimal key per sample;
+    # int64 inputs let sklearn skip its dtype-conversion copy
+    weights = np.array([1000, 100, 10, 1], dtype=np.int64)
+    true_label = np.asarray(y_true, dtype=np.int64)[:, :4] @ weights
+    pred_label = np.asarray(y_pred, dtype=np.int64)[:, :4] @ weights
+
+    cm = confusion_matrix(true_label, pred_label, labels=labels)
     print(cm)
     plot_confusion_matrix(cm=cm, target_names=target_names, title=' ', normalize=True, figsize=(14,11))
     